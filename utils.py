@@ -22,31 +22,34 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
     if num_tracks == 0:
         return X, Y
 
-    # Dictionary to keep hold of everything for every track
-    hist = [{
-            'label': "unknown",
-            'len': 0,
-            'stats': {
-                'avg': np.zeros(NUM_FEATS),
-                'max': np.zeros(NUM_FEATS),
-                'std': np.zeros(NUM_FEATS),
-            },
-            'last': [{
-                'xy': np.zeros(2),
-                'area': 0,
-            } for j in range(BUFF_LEN)],
-        } for i in range(num_tracks)]
+    # Arrays to keep hold of everything for every track (one row per track)
+    hist_label = ["unknown" for i in range(num_tracks)]
+    hist_len = np.zeros(num_tracks, dtype=int)
+    hist_avg = np.zeros((num_tracks, NUM_FEATS))
+    hist_max = np.zeros((num_tracks, NUM_FEATS))
+    hist_std = np.zeros((num_tracks, NUM_FEATS))
+    last_xy = np.zeros((num_tracks, BUFF_LEN, 2))
+    last_area = np.zeros((num_tracks, BUFF_LEN))
 
     # Find start and end frames for each track
-    track_start = [round(track["start"] * FRAMES_PER_SEC) for track in data["Tracks"]]
-    track_end = [round(track["end"] * FRAMES_PER_SEC) for track in data["Tracks"]]
+    track_start = np.rint(FRAMES_PER_SEC * np.array([track["start"] for track in data["Tracks"]])).astype(int)
+    track_end = np.rint(FRAMES_PER_SEC * np.array([track["end"] for track in data["Tracks"]])).astype(int)
 
     # Check each track for a manual classification
     for track_counter in range(num_tracks):
         for tag in data["Tracks"][track_counter]["tags"]:
             if tag["automatic"]==False:
-                hist[track_counter]["label"] = tag["what"]
+                hist_label[track_counter] = tag["what"]
                 break
+    labelled = np.array([label != "unknown" for label in hist_label])
+
+    # Parse tracked positions of labelled tracks into arrays up front (one row per frame: order, left, top, right, bottom)
+    track_boxes = [None for i in range(num_tracks)]
+    for track_counter in np.flatnonzero(labelled):
+        positions = data["Tracks"][track_counter]["positions"]
+        boxes = np.array([[pos["order"], pos["x"], pos["y"], pos["width"], pos["height"]] for pos in positions], dtype=int).reshape(-1, 5)
+        boxes[:, 3:5] += boxes[:, 1:3]
+        track_boxes[track_counter] = boxes
 
     # Start reading image frames + tracker data
     with open(cptvFile, "rb") as f:
@@ -63,6 +66,7 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
             
         frame_counter = -1
         back_img = None
+        back_median = 0.0
         got_background = False
         
         # Loop over all image frames
@@ -71,6 +75,7 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
             # Skip over background frames
             if frame.background_frame:
                 back_img = frame.pix.astype(float)
+                back_median = np.median(back_img)   # Only changes when a new background frame arrives
                 got_background = True
                 continue
             
@@ -82,40 +87,42 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
 
             frame_counter += 1
 
-            # Check if any tracks overlap this frame (note there can be more than one!)
-            overlapping_tracks = [i for i in range(num_tracks) if frame_counter >= track_start[i] and frame_counter < track_end[i]]
+            # Check if any labelled tracks overlap this frame (note there can be more than one!)
+            # (one vectorised comparison against all tracks rather than a Python loop over them)
+            overlapping_tracks = np.flatnonzero(labelled & (track_start <= frame_counter) & (frame_counter < track_end))
 
             # Skip frame if nothing is going on
             if len(overlapping_tracks) == 0:
                 continue
 
             img = frame.pix.astype(float)
+            img_h, img_w = img.shape
             found_valid_tracks = False
 
             # Try to fix brightness fluctations to match with background frame
-            img += np.median(back_img) - np.median(img)
+            img += back_median - np.median(img)
 
             for track_counter in overlapping_tracks:
-                
-                if hist[track_counter]["label"] == "unknown":
-                    continue
 
                 # Get tracked position
-                positions = data["Tracks"][track_counter]["positions"]
-                pos = positions[frame_counter-track_start[track_counter]]
-                assert pos["order"] == frame_counter
+                order, left, top, right, bottom = track_boxes[track_counter][frame_counter-track_start[track_counter]].tolist()
+                assert order == frame_counter
+
+                # Clamp tracked box to the image, then take the crops once for all the features below
+                x1 = min(max(left, 0), img_w)
+                y1 = min(max(top, 0), img_h)
+                x2 = min(max(right, 0), img_w)
+                y2 = min(max(bottom, 0), img_h)
 
                 min_size = 2
-                if pos["width"] < min_size or pos["height"] < min_size:
+                if x2 - x1 < min_size or y2 - y1 < min_size:
                     continue
 
-                x1 = pos["x"]
-                y1 = pos["y"]
-                x2 = pos["x"] + pos["width"]
-                y2 = pos["y"] + pos["height"]
+                img_crop = img[y1:y2, x1:x2]
+                back_crop = back_img[y1:y2, x1:x2]
 
-                sub = img[y1:y2, x1:x2] - back_img[y1:y2, x1:x2]
-                sub = np.abs(sub)
+                sub = img_crop - back_crop
+                np.abs(sub, out=sub)
                 sub_max = sub.max()
                 if sub_max > 0.0:
                     sub /= sub_max
@@ -129,47 +136,38 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
                 elongation = extent[0] / extent[1]
                 
                 # Instantaneous intensity features
-                std_back = np.std(back_img[y1:y2, x1:x2]) + 1.0e-9
-                peak_snr = (np.max(img[y1:y2, x1:x2]) - np.mean(back_img[y1:y2, x1:x2])) / std_back
-                mean_snr = np.std(img[y1:y2, x1:x2]) / std_back
+                # (background mean computed once and shared between the std and the peak SNR)
+                mean_back = np.mean(back_crop)
+                dev_back = back_crop - mean_back
+                std_back = np.sqrt(np.mean(dev_back*dev_back)) + 1.0e-9
+                peak_snr = (np.max(img_crop) - mean_back) / std_back
+                mean_snr = np.std(img_crop) / std_back
                 fill_factor = np.sum(sub) / area
 
-                # Time-based features
-                speed = np.zeros(BUFF_LEN)
-                rel_speed = np.zeros(BUFF_LEN)
-                rel_speed_x = np.zeros(BUFF_LEN)
-                rel_speed_y = np.zeros(BUFF_LEN)
-                for k in range(BUFF_LEN):
-                    if hist[track_counter]["len"] > k:
-                        j = (hist[track_counter]["len"] - k - 1) % BUFF_LEN
-                        vel = cent - hist[track_counter]["last"][j]["xy"]
-                        speed[k] = np.sqrt(np.sum(vel*vel))
-                        rel_speed[k] = speed[k] / sqrt_area
-                        rel_speed_x[k] = np.abs(vel[0]) / sqrt_area
-                        rel_speed_y[k] = np.abs(vel[1]) / sqrt_area
-
-                # Bundle all features into vector
-                feats = np.array([
-                    sqrt_area,
-                    elongation,
-                    peak_snr,
-                    mean_snr,
-                    fill_factor,
-                    speed[0], rel_speed[0], rel_speed_x[0], rel_speed_y[0],
-                    speed[2], rel_speed[2], rel_speed_x[2], rel_speed_y[2],
-                    speed[4], rel_speed[4], rel_speed_x[4], rel_speed_y[4],
-                    ])
+                # Time-based features (distances to all remembered positions at once, most recent first)
+                motion = np.zeros((BUFF_LEN, 4))    # Columns: speed, rel_speed, rel_speed_x, rel_speed_y
+                n = min(hist_len[track_counter], BUFF_LEN)
+                j = (hist_len[track_counter] - 1 - np.arange(n)) % BUFF_LEN
+                vel = cent - last_xy[track_counter, j]
+                motion[:n, 0] = np.sqrt(np.sum(vel*vel, axis=1))
+                motion[:n, 1] = motion[:n, 0] / sqrt_area
+                motion[:n, 2:4] = np.abs(vel) / sqrt_area
+
+                # Bundle all features into vector (filled in place rather than built from a Python list)
+                feats = np.empty(NUM_FEATS)
+                feats[0:5] = (sqrt_area, elongation, peak_snr, mean_snr, fill_factor)
+                feats[5:] = motion[0::2].ravel()    # Motion over 1, 3 and 5 frames
 
                 # Remember some stuff for next time
-                j = hist[track_counter]["len"] % BUFF_LEN
-                hist[track_counter]["last"][j]["xy"] = cent
-                hist[track_counter]["last"][j]["area"] = area
-                hist[track_counter]["len"] += 1
+                j = hist_len[track_counter] % BUFF_LEN
+                last_xy[track_counter, j] = cent
+                last_area[track_counter, j] = area
+                hist_len[track_counter] += 1
 
                 # Aggregate
-                hist[track_counter]["stats"]["avg"] += feats
-                hist[track_counter]["stats"]["std"] += feats*feats
-                hist[track_counter]["stats"]["max"] = np.maximum(feats, hist[track_counter]["stats"]["max"])
+                hist_avg[track_counter] += feats
+                hist_std[track_counter] += feats*feats
+                np.maximum(feats, hist_max[track_counter], out=hist_max[track_counter])
 
                 # Prepare image for display (first time around)
                 if not found_valid_tracks:
@@ -183,12 +181,12 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
                     rgb = cv2.merge([rgb,rgb,rgb])
 
                 # Overlay tracking details
-                x1 = ENLARGE_FACTOR * pos["x"] - 1
-                y1 = ENLARGE_FACTOR * pos["y"] - 1
-                x2 = ENLARGE_FACTOR * (pos["x"] + pos["width"])
-                y2 = ENLARGE_FACTOR * (pos["y"] + pos["height"])
+                x1 = ENLARGE_FACTOR * left - 1
+                y1 = ENLARGE_FACTOR * top - 1
+                x2 = ENLARGE_FACTOR * right
+                y2 = ENLARGE_FACTOR * bottom
                 #cv2.rectangle(rgb, (x1,y1), (x2,y2), (255,0,0))
-                cv2.putText(rgb, hist[track_counter]["label"], (x1,y1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0))
+                cv2.putText(rgb, hist_label[track_counter], (x1,y1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0))
                 cent = (round(ENLARGE_FACTOR*cent[0]), round(ENLARGE_FACTOR*cent[1]))
                 axes = (round(2*ENLARGE_FACTOR*extent[0]), round(2*ENLARGE_FACTOR*extent[1]))
                 cv2.ellipse(rgb, cent, axes, round(np.degrees(theta)), 0, 360, (0,255,0))
@@ -198,23 +196,18 @@ def process_sequence(cptvFile, data, FRAMES_PER_SEC=9.0, ENLARGE_FACTOR=4, PLAYB
                 cv2.imshow("image", rgb)
                 cv2.waitKey(PLAYBACK_DELAY)
 
-    # Compute statistics for all tracks that have the min required duration
-    valid_counter = 0
-    for track_counter in range(num_tracks):
-        num_frames = hist[track_counter]["len"]
-        if num_frames > BUFF_LEN:
-            N = num_frames - np.array([0,0,0,0,0,1,1,1,1,3,3,3,3,5,5,5,5])  # Normalise each measure by however many samples went into it
-            hist[track_counter]["stats"]["avg"] /= N
-            hist[track_counter]["stats"]["std"] = np.sqrt(hist[track_counter]["stats"]["std"] / N - hist[track_counter]["stats"]["avg"]**2)
-            X[valid_counter, 0:NUM_FEATS] = hist[track_counter]["stats"]["avg"]
-            X[valid_counter, NUM_FEATS:2*NUM_FEATS] = hist[track_counter]["stats"]["std"]
-            X[valid_counter, 2*NUM_FEATS:3*NUM_FEATS] = hist[track_counter]["stats"]["max"]
-            X[valid_counter, 3*NUM_FEATS] = num_frames
-            Y[valid_counter] = hist[track_counter]["label"]
-            valid_counter += 1
-
-    X = X[0:valid_counter,:]
-    Y = Y[0:valid_counter]
+    # Compute statistics for all tracks that have the min required duration (all at once, one row per track)
+    valid = np.flatnonzero(hist_len > BUFF_LEN)
+    num_frames = hist_len[valid]
+    N = num_frames[:, None] - np.array([0,0,0,0,0,1,1,1,1,3,3,3,3,5,5,5,5])  # Normalise each measure by however many samples went into it
+    avg = hist_avg[valid] / N
+    std = np.sqrt(hist_std[valid] / N - avg**2)
+    X = X[0:len(valid),:]
+    X[:, 0:NUM_FEATS] = avg
+    X[:, NUM_FEATS:2*NUM_FEATS] = std
+    X[:, 2*NUM_FEATS:3*NUM_FEATS] = hist_max[valid]
+    X[:, 3*NUM_FEATS] = num_frames
+    Y = [hist_label[i] for i in valid]
 
     return X, Y
 